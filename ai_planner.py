@@ -1,44 +1,99 @@
+import asyncio
+import copy
+import hashlib
 import json
-import os
-import streamlit as st
-from openai import OpenAI
+import logging
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 
+import planner_cache
+from config import get_int_setting, get_openai_client, get_setting
 
-def _get_api_key(api_key=None):
-    """
-    Retrieves OpenAI API Key from args, Streamlit secrets, or environment variables.
-    """
-    if api_key:
-        return api_key
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-    # Try Streamlit Secrets
-    try:
-        if hasattr(st, "secrets") and "OPENAI_API_KEY" in st.secrets:
-            return st.secrets["OPENAI_API_KEY"]
-    except Exception:
-        pass
+logger = logging.getLogger(__name__)
+_LOG_LEVEL = str(get_setting("LOG_LEVEL", "INFO")).upper()
+# An unknown level name falls back to INFO instead of failing the import
+logger.setLevel(_LOG_LEVEL if isinstance(logging.getLevelName(_LOG_LEVEL), int) else logging.INFO)
 
-    # Try Environment Variable
-    return os.getenv("OPENAI_API_KEY")
+# Exact-match cache of generated plans, keyed by SHA-256 of (model, prompt).
+# Entries are (expires_at, plan); plans are deep-copied in and out so callers
+# can mutate the returned dict freely. Backed by planner_cache on disk.
+# Kept in LRU order and capped at _RESPONSE_CACHE_MAX entries.
+_RESPONSE_CACHE = OrderedDict()
+_RESPONSE_CACHE_TTL = 3600  # seconds
+_RESPONSE_CACHE_MAX = 256
+_RESPONSE_CACHE_LOCK = threading.Lock()
 
+# Singleflight: concurrent identical requests (same cache key) wait on the
+# first caller's Future instead of issuing their own API call.
+_INFLIGHT = {}
+_INFLIGHT_LOCK = threading.Lock()
 
-def generate_slide_plan(parsed_data, api_key=None, model="gpt-4o"):
-    """
-    Generates a JSON plan for a VIDEO-oriented presentation using OpenAI API.
-    """
-    final_api_key = _get_api_key(api_key)
+# Opt-in semantic cache (SEMANTIC_CACHE=1): lightly edited inputs reuse a
+# previous plan when their embedding is close enough to a cached one.
+# Entries are (model, unit_vector, plan), oldest first; persisted entries
+# are loaded from planner_cache on first use. _SEMANTIC_LOCK guards the
+# list, the counters below and every read/write of the JSONL file.
+_SEMANTIC_CACHE = []
+_SEMANTIC_LOADED = False
+_SEMANTIC_CACHE_MAX = 256
+# Lines in the JSONL file beyond what _SEMANTIC_CACHE holds; the file is
+# compacted once this reaches _SEMANTIC_CACHE_MAX so it stays bounded.
+_SEMANTIC_STALE_LINES = 0
+_SEMANTIC_LOCK = threading.Lock()
+_EMBEDDING_MODEL = "text-embedding-3-small"
 
-    if not final_api_key:
-        raise ValueError(
-            "OPENAI_API_KEY is not set. Please set it in Streamlit Secrets or environment variables."
-        )
+# Slide fields read by image_generator / slide_builder, with factories for
+# missing values. Built once at import; _fix_slide only walks this table.
+_SLIDE_DEFAULTS = (
+    ("title", str),
+    ("takeaway", str),
+    ("bullets", tuple),
+    ("body", str),
+)
+_SLIDE_KEYS = tuple(key for key, _ in _SLIDE_DEFAULTS)
 
-    client = OpenAI(api_key=final_api_key)
+# Start of the slides array in a streamed plan response
+_SLIDES_ARRAY_RE = re.compile(r'"slides"\s*:\s*\[')
 
-    system_prompt = """You are an expert presentation designer creating slides for a **VIDEO presentation**.
+
+# One-shot example of the expected output, embedded in the system prompt.
+_EXAMPLE_PLAN = {
+    "theme": {"style": "flat", "font": "Meiryo"},
+    "slides": [
+        {
+            "title": "入力業務の工数増大",
+            "takeaway": "結論：自動化により月20時間の創出を実現します。",
+            "bullets": [
+                "転記作業に毎日1時間を費やしている",
+                "入力ミスが週平均3件発生",
+            ],
+            "body": "現在は紙の届出書を手動でシステムに入力しており、月間で約20時間の工数ロスが発生しています。例えば、申請書1枚の転記に5分かかり、ダブルチェックも含めると負担は甚大です。この単純作業を自動化することで、本来の分析業務に時間を割けるようになります。",
+            "image": {
+                "type": "illustration",
+                "prompt": "Flat vector illustration of a tired office worker with piles of paper, minimal, white background, no text",
+                "aspect_ratio": "1:1",
+            },
+        }
+    ],
+}
+
+# Static instructions sent as the system message. Kept byte-identical across
+# calls and ahead of the per-request input so OpenAI's automatic prompt
+# caching can reuse the prefix. The example plan is minified JSON: the
+# indentation carried no information but cost input tokens on every call.
+_SYSTEM_PROMPT = """You are an expert presentation designer creating slides for a **VIDEO presentation**.
 Since there is no live speaker, **all key explanations must be visible ON THE SLIDE**.
 
-## ⚠️ Video Presentation Rules
+## Video Presentation Rules
 1. **One-Claim per Slide**: Each slide must have exactly ONE main message. Split slides if necessary.
 2. **Self-Explanatory**: The slide body must contain sentences (not just bullets) that explain the "Why" and "How".
 3. **Concrete & Specific**: Avoid abstract jargon. Instead of "Optimization", say "Reduces processing time by 50%".
@@ -61,69 +116,475 @@ For each slide, generate:
   - Aspect ratio "1:1" or "4:3".
 
 ## Output Format (JSON Only)
-{
-  "theme": { "style": "flat", "font": "Meiryo" },
-  "slides": [
-    {
-      "title": "入力業務の工数増大",
-      "takeaway": "結論：自動化により月20時間の創出を実現します。",
-      "bullets": [
-        "転記作業に毎日1時間を費やしている",
-        "入力ミスが週平均3件発生"
-      ],
-      "body": "現在は紙の届出書を手動でシステムに入力しており、月間で約20時間の工数ロスが発生しています。例えば、申請書1枚の転記に5分かかり、ダブルチェックも含めると負担は甚大です。この単純作業を自動化することで、本来の分析業務に時間を割けるようになります。",
-      "image": {
-        "type": "illustration",
-        "prompt": "Flat vector illustration of a tired office worker with piles of paper, minimal, white background, no text",
-        "aspect_ratio": "1:1"
-      }
-    }
-  ]
-}
-"""
+""" + json.dumps(_EXAMPLE_PLAN, ensure_ascii=False, separators=(",", ":"))
+
+
+_SYSTEM_MESSAGE = {"role": "system", "content": _SYSTEM_PROMPT}
+_SYSTEM_PROMPT_HASH = hashlib.sha256(_SYSTEM_PROMPT.encode("utf-8"))
+
+
+def _get_api_key(api_key=None):
+    """
+    Retrieves OpenAI API Key from args, Streamlit secrets, or environment variables.
+    """
+    if api_key:
+        return api_key
+    return get_setting("OPENAI_API_KEY")
+
+
+def _loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def _dumps(obj):
+    """
+    Compact UTF-8 JSON; identical output with or without orjson installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def _cache_key(model, user_content):
+    """
+    Returns a deterministic cache key for (system prompt, model, user content).
 
-    user_content = json.dumps(parsed_data, ensure_ascii=False)
+    The static system prompt is hashed once at import; each call only copies
+    that digest state and feeds the per-request parts.
+    """
+    h = _SYSTEM_PROMPT_HASH.copy()
+    h.update(b"\0")
+    h.update(model.encode("utf-8"))
+    h.update(b"\0")
+    h.update(user_content.encode("utf-8"))
+    return h.hexdigest()
+
+
+def _memory_put(key, expires_at, plan):
+    with _RESPONSE_CACHE_LOCK:
+        _RESPONSE_CACHE[key] = (expires_at, plan)
+        _RESPONSE_CACHE.move_to_end(key)
+        while len(_RESPONSE_CACHE) > _RESPONSE_CACHE_MAX:
+            _RESPONSE_CACHE.popitem(last=False)
+
+
+def _cache_get(key):
+    with _RESPONSE_CACHE_LOCK:
+        entry = _RESPONSE_CACHE.get(key)
+        if entry is not None:
+            if entry[0] >= time.time():
+                _RESPONSE_CACHE.move_to_end(key)
+            else:
+                _RESPONSE_CACHE.pop(key, None)
+                entry = None
+    if entry is not None:
+        return copy.deepcopy(entry[1])
 
+    # Fall back to the on-disk cache (survives restarts); the entry keeps
+    # whatever is left of its original TTL rather than getting a fresh one.
+    entry = planner_cache.load(key, _RESPONSE_CACHE_TTL)
+    if entry is None:
+        return None
+    expires_at, plan = entry
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_content},
-            ],
-            response_format={"type": "json_object"},
+        plan = _validate_and_fix(plan)
+    except ValueError:
+        return None
+    _memory_put(key, expires_at, plan)
+    return copy.deepcopy(plan)
+
+
+def _cache_set(key, plan):
+    _memory_put(key, time.time() + _RESPONSE_CACHE_TTL, copy.deepcopy(plan))
+    planner_cache.store(key, plan, _RESPONSE_CACHE_TTL)
+
+
+def _semantic_cache_enabled():
+    return get_setting("SEMANTIC_CACHE", "0") == "1"
+
+
+def _embed(client, text):
+    """
+    Returns the L2-normalised embedding of text, so a dot product is the cosine.
+    """
+    response = client.embeddings.create(model=_EMBEDDING_MODEL, input=text)
+    vec = response.data[0].embedding
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return [v / norm for v in vec]
+
+
+def _semantic_entries():
+    """Returns the live entry list, loading it on first use. Caller holds _SEMANTIC_LOCK."""
+    global _SEMANTIC_LOADED
+    if not _SEMANTIC_LOADED:
+        persisted = planner_cache.load_semantic()
+        for model, embedding_model, vec, plan in persisted:
+            if embedding_model != _EMBEDDING_MODEL:
+                continue  # vectors from another embedding model are not comparable
+            try:
+                _SEMANTIC_CACHE.append((model, vec, _validate_and_fix(plan)))
+            except ValueError:
+                continue
+        del _SEMANTIC_CACHE[:-_SEMANTIC_CACHE_MAX]
+        if len(persisted) > len(_SEMANTIC_CACHE):
+            _semantic_compact()
+        _SEMANTIC_LOADED = True
+    return _SEMANTIC_CACHE
+
+
+def _semantic_compact():
+    # Caller holds _SEMANTIC_LOCK
+    global _SEMANTIC_STALE_LINES
+    planner_cache.rewrite_semantic(
+        (model, _EMBEDDING_MODEL, vec, plan) for model, vec, plan in _SEMANTIC_CACHE
+    )
+    _SEMANTIC_STALE_LINES = 0
+
+
+def _semantic_lookup(model, vec):
+    threshold = float(get_setting("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+    with _SEMANTIC_LOCK:
+        entries = list(_semantic_entries())
+    best_sim, best_plan = -1.0, None
+    for cached_model, cached_vec, plan in entries:
+        if cached_model != model:
+            continue
+        sim = sum(a * b for a, b in zip(cached_vec, vec))
+        if sim > best_sim:
+            best_sim, best_plan = sim, plan
+    if best_plan is not None and best_sim >= threshold:
+        logger.info("semantic cache hit similarity=%.3f", best_sim)
+        return copy.deepcopy(best_plan)
+    return None
+
+
+def _semantic_store(model, vec, plan):
+    global _SEMANTIC_STALE_LINES
+    plan = copy.deepcopy(plan)
+    with _SEMANTIC_LOCK:
+        entries = _semantic_entries()
+        entries.append((model, vec, plan))
+        if len(entries) > _SEMANTIC_CACHE_MAX:
+            del entries[0]
+            _SEMANTIC_STALE_LINES += 1
+        if _SEMANTIC_STALE_LINES >= _SEMANTIC_CACHE_MAX:
+            _semantic_compact()
+        else:
+            planner_cache.append_semantic(model, _EMBEDDING_MODEL, vec, plan)
+
+
+def _fix_slide(slide):
+    # Fast path: a well-formed slide (the usual case) needs no defaults
+    if None in map(slide.get, _SLIDE_KEYS):
+        for key, factory in _SLIDE_DEFAULTS:
+            if slide.get(key) is None:
+                slide[key] = factory()
+
+    # Bullets are read-only downstream; freeze them (a bare string is one bullet)
+    bullets = slide["bullets"]
+    slide["bullets"] = tuple(bullets) if isinstance(bullets, (list, tuple)) else (str(bullets),)
+    return slide
+
+
+def _validate_and_fix(plan):
+    """
+    Normalises a model-generated plan so downstream code can index it safely.
+
+    ``slides`` and each slide's ``bullets`` come back as tuples: nothing
+    downstream mutates them, and they serialize to JSON exactly like lists.
+
+    Raises ValueError if the response is not a JSON object.
+    """
+    if not isinstance(plan, dict):
+        raise ValueError("Plan response is not a JSON object")
+    if not isinstance(plan.get("theme"), dict):
+        plan["theme"] = {}
+    slides = plan.get("slides")
+    if not isinstance(slides, (list, tuple)):
+        slides = []
+    plan["slides"] = tuple(_fix_slide(sd) for sd in slides if isinstance(sd, dict))
+    return plan
+
+
+def _request_kwargs(model, user_content):
+    return {
+        "model": model,
+        "messages": [
+            _SYSTEM_MESSAGE,
+            {"role": "user", "content": user_content},
+        ],
+        "response_format": {"type": "json_object"},
+    }
+
+
+def generate_slide_plan(parsed_data, api_key=None, model="gpt-4o", use_cache=True):
+    """
+    Generates a JSON plan for a VIDEO-oriented presentation using OpenAI API.
+
+    With use_cache=False the exact-match and semantic caches are not read (a
+    fresh plan is requested), but the new plan still replaces the cached one.
+    """
+    final_api_key = _get_api_key(api_key)
+
+    if not final_api_key:
+        raise ValueError(
+            "OPENAI_API_KEY is not set. Please set it in Streamlit Secrets or environment variables."
         )
 
+    user_content = _dumps(parsed_data)
+
+    # Identical input + model returns the cached plan without an API call
+    cache_key = _cache_key(model, user_content)
+    if not use_cache:
+        return _generate_uncached(
+            final_api_key, parsed_data, model, user_content, cache_key, use_cache=False
+        )
+
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        logger.info("cache hit key=%.12s", cache_key)
+        return cached
+
+    with _INFLIGHT_LOCK:
+        future = _INFLIGHT.get(cache_key)
+        is_leader = future is None
+        if is_leader:
+            future = _INFLIGHT[cache_key] = Future()
+
+    if not is_leader:
+        logger.info("waiting on in-flight request key=%.12s", cache_key)
+        return copy.deepcopy(future.result())
+
+    try:
+        plan = _generate_uncached(final_api_key, parsed_data, model, user_content, cache_key)
+        future.set_result(plan)
+        return plan
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(cache_key, None)
+
+
+def _generate_uncached(api_key, parsed_data, model, user_content, cache_key, use_cache=True):
+    client = get_openai_client(api_key)
+
+    # Near-duplicate input: reuse a semantically similar plan (opt-in)
+    embedding = None
+    if _semantic_cache_enabled():
+        try:
+            embedding = _embed(client, user_content)
+            similar = _semantic_lookup(model, embedding) if use_cache else None
+            if similar is not None:
+                # Not stored under cache_key: it is another input's plan, and
+                # the exact-match cache must only hold plans for this input.
+                return similar
+        except Exception as e:
+            logger.warning("semantic cache unavailable: %s", e)
+
+    try:
+        response = client.chat.completions.create(**_request_kwargs(model, user_content))
+
         content = response.choices[0].message.content
-        return json.loads(content)
+        plan = _validate_and_fix(_loads(content))
+        _cache_set(cache_key, plan)
+        if embedding is not None:
+            _semantic_store(model, embedding, plan)
+        return plan
 
     except Exception as e:
-        print(f"AI Planning failed: {e}")
+        logger.warning("AI Planning failed: %s", e)
         return _create_fallback_plan(parsed_data)
 
 
+def _iter_stream_slides(chunks):
+    """
+    Yields each slide object from a streamed plan JSON as soon as it is complete.
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = None  # index of the next unread character inside the slides array
+
+    for chunk in chunks:
+        buf += chunk
+        if pos is None:
+            m = _SLIDES_ARRAY_RE.search(buf)
+            if not m:
+                continue
+            pos = m.end()
+
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buf) or buf[pos] == "]":
+                break
+            try:
+                slide, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                break  # slide object not fully received yet
+            yield slide
+
+
+def stream_slide_plan(parsed_data, api_key=None, model="gpt-4o"):
+    """
+    Streams the slide plan, yielding each slide dict as soon as it is generated.
+
+    Useful for progressive rendering: the first slide is available long before
+    the full response arrives. The complete plan is cached like
+    generate_slide_plan once the stream finishes.
+    """
+    final_api_key = _get_api_key(api_key)
+
+    if not final_api_key:
+        raise ValueError(
+            "OPENAI_API_KEY is not set. Please set it in Streamlit Secrets or environment variables."
+        )
+
+    user_content = _dumps(parsed_data)
+
+    cache_key = _cache_key(model, user_content)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        yield from cached.get("slides", [])
+        return
+
+    client = get_openai_client(final_api_key)
+    pieces = []
+    emitted = 0
+
+    def _deltas(stream):
+        for event in stream:
+            if not event.choices:
+                continue
+            delta = event.choices[0].delta.content
+            if delta:
+                pieces.append(delta)
+                yield delta
+
+    try:
+        stream = client.chat.completions.create(
+            stream=True, **_request_kwargs(model, user_content)
+        )
+        for slide in _iter_stream_slides(_deltas(stream)):
+            if not isinstance(slide, dict):
+                continue
+            emitted += 1
+            yield _fix_slide(slide)
+        _cache_set(cache_key, _validate_and_fix(_loads("".join(pieces))))
+
+    except Exception as e:
+        logger.warning("AI Planning failed: %s", e)
+        if emitted == 0:
+            yield from _create_fallback_plan(parsed_data)["slides"]
+
+
+async def _agenerate_one(client, parsed_data, model, sem, inflight):
+    user_content = _dumps(parsed_data)
+
+    cache_key = _cache_key(model, user_content)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Identical documents within the batch share one request
+    task = inflight.get(cache_key)
+    if task is None:
+        task = inflight[cache_key] = asyncio.ensure_future(
+            _arequest_plan(client, parsed_data, model, sem, user_content, cache_key)
+        )
+    return copy.deepcopy(await task)
+
+
+async def _arequest_plan(client, parsed_data, model, sem, user_content, cache_key):
+    async with sem:
+        try:
+            response = await client.chat.completions.create(
+                **_request_kwargs(model, user_content)
+            )
+            plan = _validate_and_fix(_loads(response.choices[0].message.content))
+            _cache_set(cache_key, plan)
+            return plan
+        except Exception as e:
+            logger.warning("AI Planning failed: %s", e)
+            return _create_fallback_plan(parsed_data)
+
+
+def generate_slide_plans_batch(parsed_list, api_key=None, model="gpt-4o"):
+    """
+    Generates plans for several parsed documents concurrently.
+
+    Requests share one async client and are bounded by GEN_QPS (default 8)
+    in-flight calls. Results are returned in input order; a failed document
+    gets the same fallback plan as generate_slide_plan.
+    """
+    final_api_key = _get_api_key(api_key)
+
+    if not final_api_key:
+        raise ValueError(
+            "OPENAI_API_KEY is not set. Please set it in Streamlit Secrets or environment variables."
+        )
+
+    from openai import AsyncOpenAI
+
+    # The async client is bound to the event loop created by asyncio.run,
+    # so it is built per batch (and closed with it) rather than cached.
+    async def _run():
+        async with AsyncOpenAI(api_key=final_api_key) as client:
+            sem = asyncio.Semaphore(get_int_setting("GEN_QPS", 8, minimum=1))
+            inflight = {}
+            return await asyncio.gather(
+                *(_agenerate_one(client, p, model, sem, inflight) for p in parsed_list)
+            )
+
+    return asyncio.run(_run())
+
+
+# Static parts of the fallback plan; per-slide copies are taken with deepcopy.
+_FALLBACK_SLIDE_TPL = {
+    "title": "",
+    "takeaway": "結論：詳細を確認してください。",
+    "bullets": [],
+    "body": "（APIエラーのため自動生成できませんでした。内容を補足してください。）",
+    "image": {
+        "type": "placeholder",
+        "prompt": "Placeholder image",
+        "aspect_ratio": "1:1",
+    },
+}
+_FALLBACK_THEME_TPL = {"style": "simple"}
+
+
 def _create_fallback_plan(parsed_data):
     """
     Creates a basic plan without AI intelligence if API fails.
+
+    Normalised through _validate_and_fix so it has the same shape (tuple
+    slides / bullets) as a generated plan.
     """
     slides = []
 
     for s in parsed_data.get("slides", []):
-        slides.append(
-            {
-                "title": s.get("title", ""),
-                "takeaway": "結論：詳細を確認してください。",
-                "bullets": s.get("bullets", []),
-                "body": "（APIエラーのため自動生成できませんでした。内容を補足してください。）",
-                "image": {
-                    "type": "placeholder",
-                    "prompt": "Placeholder image",
-                    "aspect_ratio": "1:1",
-                },
-            }
-        )
+        slide = copy.deepcopy(_FALLBACK_SLIDE_TPL)
+        slide["title"] = s.get("title", "")
+        slide["bullets"] = list(s.get("bullets", []))
+        slides.append(slide)
 
-    return {
-        "theme": {"style": "simple"},
+    return _validate_and_fix({
+        "theme": dict(_FALLBACK_THEME_TPL),
         "slides": slides,
-    }
+    })
+
+
+def warmup():
+    """
+    Imports the OpenAI SDK ahead of the first plan so the first Generate click
+    does not pay for it. Safe to run in a background thread: it does not touch
+    Streamlit, and the client itself is still built on the script thread.
+    """
+    try:
+        import openai  # noqa: F401
+    except Exception as e:
+        logger.warning("prewarm failed: %s", e)
@@ -9,42 +9,76 @@ Pipeline:
 """
 
 import streamlit as st
+import io
+import logging
 import os
-import shutil
+import threading
 
+from config import get_setting
 from markdown_parser import parse_markdown
-from ai_planner import generate_slide_plan
+from ai_planner import generate_slide_plan, warmup
 from image_generator import generate_slide_images, STYLE_PROMPTS
-from slide_builder import generate_pptx
 
-# Optional: load .env locally (app.py might run before other modules)
-try:
-    from dotenv import load_dotenv
-    load_dotenv()
-except Exception:
-    pass
+# --- Config ---
+# Send module loggers (ai_planner) to stderr; a no-op on Streamlit reruns.
+logging.basicConfig(format="%(asctime)s [%(name)s] %(levelname)s %(message)s")
+
+ASSETS_DIR = "assets"
+PREVIEW_WIDTH = 240
+PREVIEW_MAX_PX = 512
 
-def _get_secret(key, default=None):
-    """st.secrets を優先し、なければ os.getenv にフォールバック。"""
+
+def _prune_assets(keep):
+    """Unlink files in ASSETS_DIR that are not in keep (the directory itself stays)."""
+    keep = {os.path.abspath(p) for p in keep}
     try:
-        if hasattr(st, "secrets") and key in st.secrets:
-            return str(st.secrets[key]).strip()
-    except Exception:
-        pass
-    return os.getenv(key, default)
+        entries = list(os.scandir(ASSETS_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.is_file() and os.path.abspath(entry.path) not in keep:
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                pass
+
+
+def _preview_image(path):
+    """Downscaled copy of a slide image for the preview grid (PPTX keeps full res)."""
+    from PIL import Image
+
+    with Image.open(path) as img:
+        img.thumbnail((PREVIEW_MAX_PX, PREVIEW_MAX_PX))
+        img.load()
+        return img.copy()
 
-# --- Config ---
-ASSETS_DIR = "assets"
-OUTPUT_FILENAME = "presentation.pptx"
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _cached_parse(md):
+    """parse_markdown is a pure function of the input text; memoise it across reruns."""
+    return parse_markdown(md)
+
+
+@st.cache_resource(show_spinner=False)
+def _start_prewarm():
+    """Start ai_planner.warmup in the background once per process (not per rerun)."""
+    thread = threading.Thread(target=warmup, name="ai_planner-prewarm", daemon=True)
+    thread.start()
+    return thread
 
 
 def main():
     st.set_page_config(page_title="AI Slide Generator", layout="wide")
+
+    # Pay the SDK import off the critical path of the first Generate click.
+    # Disable with PREWARM=0.
+    if get_setting("PREWARM", "1") == "1":
+        _start_prewarm()
     
     st.title("✨ AI PowerPoint Generator (OpenAI Edition)")
     
     # Check API Key
-    openai_api_key = _get_secret("OPENAI_API_KEY")
+    openai_api_key = get_setting("OPENAI_API_KEY")
     
     st.markdown("Markdown → AI Plan (GPT-4o) → AI Images ({Style} + DALL·E 3) → PPTX")
 
@@ -58,12 +92,20 @@ def main():
             st.error("OPENAI_API_KEY not found. Please set it in .env or Secrets.")
 
         # Config
-        image_model = _get_secret("IMAGE_MODEL_NAME", "dall-e-3")
+        image_model = get_setting("IMAGE_MODEL_NAME", "dall-e-3")
         st.text_input("Image Model", value=image_model, disabled=True)
         
         # Image Style Selection
         style_options = list(STYLE_PROMPTS.keys())
         selected_style = st.selectbox("Image Style", style_options, index=0)
+        force_regenerate = st.checkbox(
+            "Force regenerate images", value=False,
+            help="Ignore previously generated images and request new ones.",
+        )
+        force_replan = st.checkbox(
+            "Force regenerate plan", value=False,
+            help="Ignore the cached slide plan and request a new one.",
+        )
         
         st.info(f"Style: {selected_style}\n(OpenAI API for Planning & Images)")
 
@@ -97,20 +139,22 @@ def main():
         try:
             # 1. Parse
             status.write("📝 Parsing Markdown...")
-            parsed_data = parse_markdown(user_input)
+            parsed_data = _cached_parse(user_input)
             st.json(parsed_data, expanded=False)
             
             # 2. Plan (AI - OpenAI)
             status.write("🧠 AI Planning (GPT-4o) - One-Claim Policy...")
-            plan = generate_slide_plan(parsed_data, api_key=openai_api_key)
+            plan = generate_slide_plan(
+                parsed_data, api_key=openai_api_key, use_cache=not force_replan
+            )
             st.write("--- Design Plan ---")
             st.json(plan, expanded=False)
             
             # 3. Images (AI - DALL-E 3)
             status.write(f"🎨 Generating Images ({selected_style} - {image_model})...")
-            # Cleanup old assets
-            if os.path.exists(ASSETS_DIR):
-                shutil.rmtree(ASSETS_DIR)
+            # Images are content-addressed, so unchanged slides are reused.
+            if force_regenerate:
+                _prune_assets(keep=())
 
             image_paths = generate_slide_images(
                 plan,
@@ -118,31 +162,38 @@ def main():
                 api_key=openai_api_key,
                 model_name=image_model,
                 image_style=selected_style,
+                use_cache=not force_regenerate,
             )
+            # Drop images no longer referenced by this deck
+            _prune_assets(keep=image_paths.values())
             
             # Show previews
             if image_paths:
-                cols = st.columns(4)
-                for i, path in image_paths.items():
-                    with cols[i % 4]:
-                        st.image(path, caption=f"Slide {i+1}", use_container_width=True)
+                indices = list(image_paths)
+                st.image(
+                    [_preview_image(image_paths[i]) for i in indices],
+                    caption=[f"Slide {i+1}" for i in indices],
+                    width=PREVIEW_WIDTH,
+                )
             else:
                 st.warning("No images generated (failed or skipped). Proceeding with text only.")
             
             # 4. Build PPTX
             status.write("🔨 Building PowerPoint...")
-            output_path = generate_pptx(plan, image_paths, OUTPUT_FILENAME, title=parsed_data['title'])
+            # python-pptx/lxml are only needed here; keep them off first paint
+            from slide_builder import generate_pptx
+            # Build straight into memory: the file is only ever downloaded
+            pptx_buffer = generate_pptx(plan, image_paths, io.BytesIO(), title=parsed_data['title'])
             
             status.update(label="✅ Complete!", state="complete", expanded=False)
             
             # 5. Download
-            with open(output_path, "rb") as f:
-                st.download_button(
-                    label="Download .pptx",
-                    data=f,
-                    file_name="ai_presentation.pptx",
-                    mime="application/vnd.openxmlformats-officedocument.presentationml.presentation",
-                )
+            st.download_button(
+                label="Download .pptx",
+                data=pptx_buffer.getvalue(),
+                file_name="ai_presentation.pptx",
+                mime="application/vnd.openxmlformats-officedocument.presentationml.presentation",
+            )
 
         except Exception as e:
             status.update(label="Error", state="error")
@@ -4,27 +4,58 @@ Unified configuration & GCP authentication bootstrap.
 Priority: Streamlit Secrets > Environment Variables > Defaults
 """
 
+import functools
 import os
 import tempfile
 
 import streamlit as st
 
+# Load .env before any lookup: get_setting memoises, so a value read before
+# .env is loaded would stick for the lifetime of the process.
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except Exception:
+    pass
+
 
 # ---------------------------------------------------------------------------
 # get_setting: single entry-point for all config values
 # ---------------------------------------------------------------------------
 
+@functools.lru_cache(maxsize=64)
 def get_setting(key, default=None):
-    """Return a config value with priority: st.secrets > os.getenv > default."""
+    """
+    Return a config value with priority: st.secrets > os.getenv > default.
+
+    Memoised per (key, default): settings do not change within a process.
+    Call ``get_setting.cache_clear()`` after changing them at runtime.
+    """
     try:
-        val = st.secrets[key]
+        val = st.secrets.get(key)
         if val is not None:
             return str(val).strip()
     except Exception:
-        pass
+        pass  # no secrets.toml configured
     return os.getenv(key, default)
 
 
+def get_int_setting(key, default, minimum=0):
+    """
+    Return ``get_setting(key)`` as an int of at least ``minimum``.
+
+    A missing or malformed value falls back to ``default`` (with a warning)
+    instead of raising, so a typo in secrets/env cannot break the app.
+    """
+    raw = get_setting(key)
+    try:
+        value = default if raw is None else int(raw)
+    except (TypeError, ValueError):
+        print(f"[CONFIG][WARN] {key}={raw!r} is not an integer, using {default}")
+        value = default
+    return max(minimum, value)
+
+
 # ---------------------------------------------------------------------------
 # GCP service-account bootstrap (for Streamlit Cloud)
 # ---------------------------------------------------------------------------
@@ -67,6 +98,24 @@ def bootstrap_gcp_auth():
         st.error(msg)
 
 
+# ---------------------------------------------------------------------------
+# Shared API clients
+# ---------------------------------------------------------------------------
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key):
+    """
+    Return a process-wide OpenAI client for ``api_key``.
+
+    Cached across Streamlit reruns and shared by planning and image
+    generation, so the HTTP connection pool (and its TLS sessions) is reused.
+    The SDK is imported on first use.
+    """
+    from openai import OpenAI
+
+    return OpenAI(api_key=api_key)
+
+
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
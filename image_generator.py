@@ -1,49 +1,56 @@
 """
 Phase C: Generate visuals for each slide.
 
-Routing:
-  - visual_type=SCENE  → Imagen generation (fallback: PPT shapes via slide_builder)
-  - visual_type=DIAGRAM → Skip Imagen entirely; return diagram metadata
-                           for slide_builder to draw PPT shapes
-
 Features:
-  - Retry up to 2 times with prompt simplification on SCENE failure
-  - Never leaves a slide without visual content
+  - One OpenAI image request per distinct prompt, run concurrently
+  - Content-addressed filenames: unchanged prompts reuse the image on disk
+  - Only slides whose plan carries an ``image`` block are sent to the API;
+    the rest are laid out by slide_builder without a network call
 """
 
 import os
-import io
+import base64
+import functools
+import hashlib
+import random
+import shutil
+import tempfile
+import time
 import requests
+from requests.adapters import HTTPAdapter
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import streamlit as st
-from openai import OpenAI
-
-# Optional: load .env locally
-try:
-    from dotenv import load_dotenv
-    load_dotenv()
-except Exception:
-    pass
 
-DEBUG_IMAGES = os.environ.get("DEBUG_IMAGES", "False").lower() == "true"
+from config import get_int_setting, get_openai_client, get_setting
+
+DEBUG_IMAGES = str(get_setting("DEBUG_IMAGES", "False")).lower() == "true"
+# Upper bound on in-flight image requests (provider rate limits apply).
+IMAGE_CONCURRENCY = get_int_setting("IMAGE_CONCURRENCY", 8, minimum=1)
+RATE_LIMIT_ATTEMPTS = 6
+TRANSIENT_ATTEMPTS = 3
+# Per-attempt bound (seconds). A timeout is retried as a transient error, so
+# a slide whose requests all hang gives up after TRANSIENT_ATTEMPTS x
+# IMAGE_TIMEOUT (~3 min); rate-limit backoff can add up to ~1 min of sleeps.
+IMAGE_TIMEOUT = 60
+DOWNLOAD_TIMEOUT = 30
+# Persistent store of every generated image, shared across runs. output_dir
+# only holds the current deck and is pruned by app.py; this survives that.
+IMAGE_CACHE_DIR = os.path.join("data", "image_cache")
+# Size cap for IMAGE_CACHE_DIR; least recently used images are evicted past it.
+IMAGE_CACHE_MAX_MB = get_int_setting("IMAGE_CACHE_MAX_MB", 1024)
+
+# One keep-alive pool for all image downloads, sized to the worker count so
+# concurrent slides reuse TLS connections instead of handshaking per image.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=IMAGE_CONCURRENCY, pool_maxsize=IMAGE_CONCURRENCY))
 
 
 def _get_openai_key(api_key=None):
     """
-    Retrieves OpenAI API Key from args, secrets, or env.
+    Retrieves OpenAI API Key from args, or the memoised secrets/env lookup.
     """
-    if api_key:
-        return api_key
-
-    # Try Streamlit Secrets
-    try:
-        if hasattr(st, "secrets") and "OPENAI_API_KEY" in st.secrets:
-            return st.secrets["OPENAI_API_KEY"]
-    except Exception:
-        pass
-
-    # Try Environment Variable
-    return os.getenv("OPENAI_API_KEY")
+    return api_key or get_setting("OPENAI_API_KEY")
 
 
 STYLE_PROMPTS = {
@@ -53,21 +60,207 @@ STYLE_PROMPTS = {
     "graph": "Business flowchart or schematic diagram style, professional, clean abstract shapes, corporate look, isometric view",
 }
 
+# Aspect ratio -> DALL-E 3 supported size
+_SIZES = {"16:9": "1792x1024"}  # Landscape
+_DEFAULT_SIZE = "1024x1024"
+
+# Appended to every prompt; slide text is rendered by PowerPoint, not the model.
+_NO_TEXT_SUFFIX = (
+    "IMPORTANT: Do NOT include any text, letters, numbers, or words in the image. "
+    "No layouts, no charts with text. Visual representation only. "
+    "High quality, professional."
+)
+
+
+@functools.lru_cache(maxsize=1)
+def _retryable_errors():
+    """
+    Resolve the OpenAI exception classes once, on first use. The SDK stays
+    out of module import so it does not delay the app's first paint.
+    """
+    from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+
+    return RateLimitError, (APITimeoutError, APIConnectionError, InternalServerError)
+
+
+def _with_retries(call):
+    """
+    Runs call() with separate retry policies per failure kind:
+
+    * Rate limits (429): exponential backoff with jitter, 1s up to 60s,
+      at most RATE_LIMIT_ATTEMPTS attempts.
+    * Transient transport / 5xx errors: short fixed delay, at most
+      TRANSIENT_ATTEMPTS attempts.
+    * Anything else (e.g. a content-policy BadRequestError): no retry.
+    """
+    rate_limit_error, transient_errors = _retryable_errors()
+
+    rate_limited = transient = 0
+    while True:
+        try:
+            return call()
+        except rate_limit_error:
+            rate_limited += 1
+            if rate_limited >= RATE_LIMIT_ATTEMPTS:
+                raise
+            delay = min(60.0, 2.0 ** (rate_limited - 1))
+            time.sleep(delay + random.uniform(0, delay))
+        except transient_errors:
+            transient += 1
+            if transient >= TRANSIENT_ATTEMPTS:
+                raise
+            time.sleep(0.2)
+
+
+def _generate_one(client, prompt, size, model_name, filepath):
+    """
+    Generates one image and saves it to filepath. Runs on a worker thread.
+    """
+    model = model_name or "dall-e-3"
+    # DALL-E can return the PNG inline, saving a second round-trip to blob
+    # storage; gpt-image models always do and reject the parameter.
+    extra = {"response_format": "b64_json"} if model.startswith("dall-e") else {}
+    # _with_retries is the only retry policy; the SDK's own retries would
+    # multiply its attempt counts.
+    client = client.with_options(max_retries=0)
+    response = _with_retries(
+        lambda: client.images.generate(
+            model=model,
+            prompt=prompt,
+            size=size,
+            quality="standard",
+            n=1,
+            timeout=IMAGE_TIMEOUT,
+            **extra,
+        )
+    )
+
+    image = response.data[0]
+    if image.b64_json:
+        data = base64.b64decode(image.b64_json)
+        _write_atomic(filepath, lambda handler: handler.write(data))
+    else:
+        _write_atomic(filepath, lambda handler: _download(image.url, handler))
+
+    return filepath
+
+
+def _download(url, handler):
+    """
+    Stream url into the open binary file handler over the shared session.
+    """
+    with _SESSION.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        shutil.copyfileobj(resp.raw, handler, 1024 * 1024)
+
+
+def _write_atomic(filepath, fill):
+    """
+    Run fill(handler) against a temp file, then os.replace it into place so a
+    crash never leaves a truncated PNG under a content-addressed name (which
+    would otherwise be reused as a hit).
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath) or ".", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as handler:
+            fill(handler)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _link_or_copy(src, dst):
+    """
+    Place src at dst, as a hard link when possible (no bytes copied).
+    Returns False when src is missing.
+    """
+    try:
+        os.link(src, dst)
+    except FileNotFoundError:
+        return False
+    except FileExistsError:
+        pass
+    except OSError:
+        # Different filesystem or no hard-link support
+        try:
+            with open(src, "rb") as f:
+                _write_atomic(dst, lambda handler: shutil.copyfileobj(f, handler))
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def _touch_cached(key):
+    """Mark the cached image for key as recently used, for _prune_cache."""
+    try:
+        os.utime(os.path.join(IMAGE_CACHE_DIR, f"{key}.png"))
+    except OSError:
+        pass
+
+
+def _load_from_cache(key, filepath):
+    """Place the cached image for key at filepath; returns False on a cache miss."""
+    if not _link_or_copy(os.path.join(IMAGE_CACHE_DIR, f"{key}.png"), filepath):
+        return False
+    _touch_cached(key)
+    return True
+
 
-def generate_images(plan, output_dir="assets", api_key=None, provider=None, model_name=None, image_style="pixar"):
+def _store_in_cache(filepath):
+    """Best-effort copy of a freshly generated image into IMAGE_CACHE_DIR, replacing any older one."""
+    cache_path = os.path.join(IMAGE_CACHE_DIR, os.path.basename(filepath))
+    try:
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        try:
+            os.unlink(cache_path)
+        except FileNotFoundError:
+            pass
+        _link_or_copy(filepath, cache_path)
+    except Exception as e:
+        print(f"[IMAGE][WARN] failed to cache {os.path.basename(filepath)}: {e}")
+
+
+def _prune_cache():
+    """Evict the least recently used images until IMAGE_CACHE_DIR fits IMAGE_CACHE_MAX_MB."""
+    try:
+        entries = [
+            (e.stat().st_mtime, e.stat().st_size, e.path)
+            for e in os.scandir(IMAGE_CACHE_DIR)
+            if e.name.endswith(".png") and e.is_file()
+        ]
+    except FileNotFoundError:
+        return
+    budget = IMAGE_CACHE_MAX_MB * 1024 * 1024
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        try:
+            os.unlink(path)
+            total -= size
+        except OSError as e:
+            print(f"[IMAGE][WARN] failed to evict {os.path.basename(path)}: {e}")
+
+
+def generate_images(plan, output_dir="assets", api_key=None, provider=None, model_name=None, image_style="pixar",
+                    use_cache=True):
     """
     Generates images using OpenAI (DALL-E 3).
     Returns a dict mapping slide index (0-based) to image file path.
+
+    With use_cache=False, images already in output_dir or IMAGE_CACHE_DIR
+    are ignored (and overwritten) so every slide is generated afresh.
     """
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
 
     final_api_key = _get_openai_key(api_key)
     if not final_api_key:
         st.warning("Image Generation Skipped: OPENAI_API_KEY not found.")
         return {}
 
-    client = OpenAI(api_key=final_api_key)
+    client = get_openai_client(final_api_key)
 
     generated_paths = {}
 
@@ -77,60 +270,67 @@ def generate_images(plan, output_dir="assets", api_key=None, provider=None, mode
     # Get style prompt suffix
     style_suffix = STYLE_PROMPTS.get(image_style, STYLE_PROMPTS["pixar"])
 
+    model = model_name or "dall-e-3"
+    jobs = {}  # filepath -> [prompt, size, slide indices]
     for i, slide in enumerate(plan["slides"]):
         # Check if image is requested
-        if "image" not in slide:
+        image_cfg = slide.get("image")
+        if image_cfg is None:
             continue
 
-        image_cfg = slide["image"]
         prompt = image_cfg.get("prompt")
         if not prompt:
             st.warning(f"Slide {i+1}: No prompt provided. Skipping image.")
             continue
 
         aspect_ratio = image_cfg.get("aspect_ratio", "16:9")  # 16:9 or 1:1
-
-        # Map aspect ratio to DALL-E 3 supported sizes
-        size = "1024x1024"
-        if aspect_ratio == "16:9":
-            size = "1792x1024"  # Landscape
+        size = _SIZES.get(aspect_ratio, _DEFAULT_SIZE)
 
         # Enhance prompt to avoid text
-        enhanced_prompt = (
-            f"{style_suffix}. {prompt}. "
-            "IMPORTANT: Do NOT include any text, letters, numbers, or words in the image. "
-            "No layouts, no charts with text. Visual representation only. "
-            "High quality, professional."
-        )
-
-        filename = f"slide_{i+1}.png"
-        filepath = os.path.join(output_dir, filename)
-
-        try:
-            response = client.images.generate(
-                model=model_name or "dall-e-3",
-                prompt=enhanced_prompt,
-                size=size,
-                quality="standard",
-                n=1,
-            )
-
-            image_url = response.data[0].url
-
-            # Download the image
-            img_data = requests.get(image_url).content
-            with open(filepath, "wb") as handler:
-                handler.write(img_data)
-
-            generated_paths[i] = filepath
-
-        except Exception as e:
-            st.error(f"Slide {i+1} Image Gen Failed: {e}")
-            if DEBUG_IMAGES:
-                st.code(traceback.format_exc())
-            continue
-
-    return generated_paths
+        enhanced_prompt = f"{style_suffix}. {prompt}. {_NO_TEXT_SUFFIX}"
+
+        # Content-addressed filename: an unchanged prompt/model/size reuses
+        # the image already on disk instead of paying for a new generation.
+        key = hashlib.sha256(
+            f"{model}\0{size}\0{enhanced_prompt}".encode("utf-8")
+        ).hexdigest()[:16]
+        filepath = os.path.join(output_dir, f"{key}.png")
+        if use_cache:
+            if os.path.exists(filepath):
+                _touch_cached(key)  # reused from output_dir: still in use
+                generated_paths[i] = filepath
+                continue
+            if _load_from_cache(key, filepath):
+                generated_paths[i] = filepath
+                continue
+        # Slides with an identical prompt share one generation.
+        jobs.setdefault(filepath, [enhanced_prompt, size, []])[2].append(i)
+
+    if not jobs:
+        return generated_paths
+
+    # Slides are independent I/O-bound requests: run them concurrently.
+    # Workers must not touch st.*; errors are reported here on the main thread.
+    max_workers = max(1, min(IMAGE_CONCURRENCY, len(jobs)))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(_generate_one, client, prompt, size, model_name, filepath): indices
+            for filepath, (prompt, size, indices) in jobs.items()
+        }
+        for future in as_completed(futures):
+            indices = futures[future]
+            try:
+                path = future.result()
+                _store_in_cache(path)
+                for i in indices:
+                    generated_paths[i] = path
+            except Exception as e:
+                st.error(f"Slide {', '.join(str(i + 1) for i in indices)} Image Gen Failed: {e}")
+                if DEBUG_IMAGES:
+                    st.code(traceback.format_exc())
+
+    _prune_cache()
+    return dict(sorted(generated_paths.items()))
 
 
 # ── Public API expected by app.py ──────────────────────────────
@@ -146,4 +346,5 @@ def generate_slide_images(plan, output_dir="assets", api_key=None, **kwargs):
         provider=kwargs.get("provider"),
         model_name=kwargs.get("model_name"),
         image_style=kwargs.get("image_style", "pixar"),
+        use_cache=kwargs.get("use_cache", True),
     )
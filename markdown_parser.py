@@ -1,5 +1,13 @@
 import re
 
+# One lazy pass over the whole document instead of split + strip + startswith
+# per line; no list of lines is ever materialised. Matches "# ", "## " and
+# "- " lines (surrounding whitespace ignored) and captures the marker and the
+# stripped content; every other line is skipped.
+# [^\S\n] is "whitespace except newline" so a match never spans lines.
+_DIRECTIVE_RE = re.compile(r"^[^\S\n]*(##|#|-) [^\S\n]*(\S.*?)[^\S\n]*$", re.MULTILINE)
+
+
 def parse_markdown(text):
     """
     Parses markdown text into a simple structure.
@@ -19,38 +27,27 @@ def parse_markdown(text):
             ]
         }
     """
-    lines = text.split('\n')
     presentation_title = "Untitled Presentation"
     slides = []
     current_slide = None
 
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        
-        # Presentation Title (First H1)
-        if line.startswith('# '):
-            presentation_title = line[2:].strip()
-        
+    for match in _DIRECTIVE_RE.finditer(text):
+        marker, content = match.groups()
+
+        # Presentation Title (H1)
+        if marker == '#':
+            presentation_title = content
+
         # Slide Title (H2)
-        elif line.startswith('## '):
+        elif marker == '##':
             if current_slide:
                 slides.append(current_slide)
-            current_slide = {'title': line[3:].strip(), 'bullets': []}
-        
-        # Bullet Points
-        elif line.startswith('- '):
-            if current_slide is not None:
-                current_slide['bullets'].append(line[2:].strip())
-        
-        # Plain text handling (treat as bullet if inside slide, or ignore)
-        elif current_slide is not None and not line.startswith('#'):
-             # If user forgets dash, maybe treat as bullet?
-             # Strict requirement says "- 箇条書き", but let's be flexible
-             # current_slide['bullets'].append(line)
-             pass
-    
+            current_slide = {'title': content, 'bullets': []}
+
+        # Bullet Points (plain text lines are ignored)
+        elif current_slide is not None:
+            current_slide['bullets'].append(content)
+
     # Append the last slide
     if current_slide:
         slides.append(current_slide)
@@ -0,0 +1,145 @@
+"""
+Disk-persistent exact-match cache for slide plans.
+
+Each plan is stored as ``data/plan_cache/<key>.json`` where ``key`` is the
+SHA-256 cache key computed by ai_planner (system prompt + model + input).
+ai_planner keeps its own in-memory layer in front of this one, so the disk
+is only touched on the first hit per process and on writes. Entries expire
+``ttl`` seconds after they were written (file mtime), like the memory layer;
+``store`` also sweeps expired entries so inputs that never repeat do not
+leave files behind forever.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join("data", "plan_cache")
+# Minimum seconds between sweeps of CACHE_DIR for expired entries
+_SWEEP_INTERVAL = 600
+_last_sweep = 0.0
+
+
+def _path(key):
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+
+def load(key, ttl):
+    """
+    Return (expires_at, plan) for key, or None on miss / expired / unreadable entry.
+
+    Expired entries are removed so they are not read again.
+    """
+    path = _path(key)
+    try:
+        expires_at = os.path.getmtime(path) + ttl
+        if expires_at < time.time():
+            os.unlink(path)
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return expires_at, json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("unreadable plan cache entry %.12s: %s", key, e)
+        return None
+
+
+def _sweep(ttl):
+    """Unlink plan cache entries (and stray temp files) older than ttl."""
+    global _last_sweep
+    now = time.time()
+    if now - _last_sweep < _SWEEP_INTERVAL:
+        return
+    _last_sweep = now
+    try:
+        entries = list(os.scandir(CACHE_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime + ttl < now:
+                os.unlink(entry.path)
+        except OSError:
+            pass  # already removed by another writer
+
+
+def store(key, plan, ttl):
+    """
+    Persist plan under key. Writes are atomic; failures are logged only.
+
+    Entries older than ttl are swept at most once every _SWEEP_INTERVAL seconds.
+    """
+    tmp_path = None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(plan, f, ensure_ascii=False)
+        os.replace(tmp_path, _path(key))
+    except Exception as e:
+        logger.warning("failed to write plan cache entry %.12s: %s", key, e)
+        if tmp_path and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        return
+    _sweep(ttl)
+
+
+# ---------------------------------------------------------------------------
+# Semantic cache entries (JSONL, appended to and periodically compacted)
+# ---------------------------------------------------------------------------
+
+SEMANTIC_PATH = os.path.join("data", "semantic_cache.jsonl")
+
+
+def load_semantic():
+    """Return all persisted (model, embedding_model, vector, plan) entries, oldest first."""
+    entries = []
+    try:
+        with open(SEMANTIC_PATH, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                    entries.append((rec["model"], rec["embedding_model"], rec["vec"], rec["plan"]))
+                except (ValueError, KeyError):
+                    continue  # skip a torn or foreign line
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning("failed to read semantic cache: %s", e)
+    return entries
+
+
+def _semantic_line(model, embedding_model, vec, plan):
+    rec = {"model": model, "embedding_model": embedding_model, "vec": vec, "plan": plan}
+    return json.dumps(rec, ensure_ascii=False) + "\n"
+
+
+def rewrite_semantic(entries):
+    """Atomically replace the file with (model, embedding_model, vector, plan) entries."""
+    directory = os.path.dirname(SEMANTIC_PATH)
+    tmp_path = None
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.writelines(_semantic_line(*entry) for entry in entries)
+        os.replace(tmp_path, SEMANTIC_PATH)
+    except Exception as e:
+        logger.warning("failed to rewrite semantic cache: %s", e)
+        if tmp_path and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def append_semantic(model, embedding_model, vec, plan):
+    """Append one semantic cache entry; failures are logged only."""
+    try:
+        os.makedirs(os.path.dirname(SEMANTIC_PATH), exist_ok=True)
+        with open(SEMANTIC_PATH, "a", encoding="utf-8") as f:
+            f.write(_semantic_line(model, embedding_model, vec, plan))
+    except Exception as e:
+        logger.warning("failed to append semantic cache entry: %s", e)
@@ -1,35 +1,103 @@
 """
-Phase D: Build PPTX from deck_json and generated images.
-
-Supports three layouts:
-  - TITLE              — Cover slide (title + subtitle)
-  - TITLE_LEFT_IMAGE_RIGHT — Left text + right image (default)
-  - IMAGE_FULL_TEXT_BOTTOM  — Full-bleed image + text strip at bottom
-
-Each content slide renders:
-  - title   (in a colored header bar)
-  - message (key takeaway line, bold)
-  - body    (80-180 char description paragraph)
-  - bullets (3-5 items)
-  - image   (Imagen result or fallback shape)
-
-If no image file is available, a PPT-native shape diagram is drawn
-directly on the slide so that no slide is ever blank.
+Phase D: Build PPTX from the slide plan and generated images.
+
+Layout:
+  - Cover slide (title on the theme's primary colour)
+  - Content slides: left column (60%) + right image (40%)
+
+Each content slide renders, top to bottom in the left column:
+  - title    (heading)
+  - takeaway (key message in a tinted box, bold)
+  - bullets
+  - body     (explanatory paragraph)
+
+The image, when one was generated, is fitted ("contain") into the right
+column; slides without an image keep the right column empty.
 """
 
 from pptx import Presentation
-from pptx.util import Inches, Pt, Emu
+from pptx.util import Inches, Pt
 from pptx.dml.color import RGBColor
-from pptx.enum.text import PP_ALIGN, MSO_ANCHOR
+from pptx.enum.text import PP_ALIGN
 from pptx.enum.shapes import MSO_SHAPE
+from pptx.opc.packuri import PackURI
+from pptx.parts.image import Image as PptxImage, ImagePart
+import functools
+import itertools
 import os
+import struct
+import zipfile
 try:
     from PIL import Image
 except ImportError:
     Image = None
 
+# Media parts (PNG/JPEG) are already compressed: python-pptx deflating them
+# again costs ~0.1s per DALL-E image for <0.1% size. Store them as-is and keep
+# deflating the XML parts. This overrides a private python-pptx method, so
+# requirements.txt pins python-pptx to the 1.0.x series it was written for;
+# the hasattr guard below only skips the override if the class is reshaped.
+_STORED_EXTS = (".png", ".jpg", ".jpeg", ".gif")
+
+try:
+    from pptx.opc.serialized import _ZipPkgWriter
+
+    def _write_member(self, pack_uri, blob):
+        membername = pack_uri.membername
+        compress_type = zipfile.ZIP_STORED if membername.lower().endswith(_STORED_EXTS) else None
+        self._zipf.writestr(membername, blob, compress_type=compress_type)
+
+    if hasattr(_ZipPkgWriter, "write") and hasattr(_ZipPkgWriter, "_zipf"):
+        _ZipPkgWriter.write = _write_member
+except ImportError:
+    pass
+
+# ── Layout constants (EMU), computed once at import ──
+# Slide: widescreen 16:9 (13.33 x 7.5 inches)
+SLIDE_W = Inches(13.333)
+SLIDE_H = Inches(7.5)
+
+# Left column (60% width): Title -> Takeaway -> Bullets -> Body
+LEFT_MARGIN = Inches(0.5)
+TOP_MARGIN = Inches(0.5)
+COL_WIDTH = Inches(7.5)  # Approx 60% of 13.33 inches
+TITLE_H = Inches(1.2)
+TITLE_ADVANCE = Inches(1.3)
+TAKEAWAY_H = Inches(1.1)
+TAKEAWAY_PAD_X = Inches(0.2)
+TAKEAWAY_PAD_Y = Inches(0.1)
+TAKEAWAY_GAP = Inches(0.3)
+BULLETS_H = Inches(2.0)  # Estimated height for 3 bullets
+BULLETS_GAP = Inches(0.2)
+BODY_H = Inches(2.5)  # Remaining space roughly
+
+# Right column (40% area): Left=8.2, Top=0.5, Width=4.6, Height=6.5
+IMG_LEFT = Inches(8.2)
+IMG_TOP = Inches(0.5)
+IMG_W = Inches(4.6)
+IMG_H = Inches(6.5)
+
+# Cover title box
+COVER_BOX = (Inches(1), Inches(2.5), Inches(11), Inches(2.5))
+
+PT_12 = Pt(12)
+PT_20 = Pt(20)
+PT_24 = Pt(24)
+PT_36 = Pt(36)
+PT_54 = Pt(54)
+
+WHITE = RGBColor(255, 255, 255)
+BLACK = RGBColor(0, 0, 0)
+TAKEAWAY_BG = RGBColor(230, 240, 255)  # Light Blue bg
+TAKEAWAY_LINE = RGBColor(100, 150, 230)
+TAKEAWAY_FG = RGBColor(0, 50, 100)
+BULLET_FG = RGBColor(30, 30, 30)
+BODY_FG = RGBColor(50, 50, 50)
+
+
+@functools.lru_cache(maxsize=256)
 def _hex_to_rgb(hex_color):
-    """Convert hex color string to RGBColor."""
+    """Convert hex color string to RGBColor (memoised; RGBColor is immutable)."""
     hex_color = hex_color.lstrip('#')
     if len(hex_color) != 6:
         return RGBColor(43, 87, 154)
@@ -50,97 +118,139 @@ def _create_left_column(slide, title, takeaway, bullets, body, font_name):
     Creates the left column content (60% width):
     Title -> Takeaway -> Bullets -> Body
     """
-    LEFT_MARGIN = Inches(0.5)
-    TOP_MARGIN = Inches(0.5)
-    COL_WIDTH = Inches(7.5)  # Approx 60% of 13.33 inches
-
     current_top = TOP_MARGIN
 
     # 1. Title (Heading)
     if title:
-        tx = slide.shapes.add_textbox(LEFT_MARGIN, current_top, COL_WIDTH, Inches(1.2))
+        tx = slide.shapes.add_textbox(LEFT_MARGIN, current_top, COL_WIDTH, TITLE_H)
         tf = tx.text_frame
         tf.word_wrap = True
         p = tf.paragraphs[0]
         p.text = title
-        p.font.size = Pt(36)
+        p.font.size = PT_36
         p.font.bold = True
         p.font.name = font_name
-        p.font.color.rgb = RGBColor(0, 0, 0)
+        p.font.color.rgb = BLACK
         
-        current_top += Inches(1.3)
+        current_top += TITLE_ADVANCE
 
     # 2. Takeaway (Emphasis Box)
     if takeaway:
-        box_h = Inches(1.1)
         # Background box
         shape = slide.shapes.add_shape(
-            MSO_SHAPE.RECTANGLE, LEFT_MARGIN, current_top, COL_WIDTH, box_h
+            MSO_SHAPE.RECTANGLE, LEFT_MARGIN, current_top, COL_WIDTH, TAKEAWAY_H
         )
         shape.fill.solid()
-        shape.fill.fore_color.rgb = RGBColor(230, 240, 255)  # Light Blue bg
-        shape.line.color.rgb = RGBColor(100, 150, 230)
+        shape.fill.fore_color.rgb = TAKEAWAY_BG
+        shape.line.color.rgb = TAKEAWAY_LINE
         
         # Text inside
-        tx = slide.shapes.add_textbox(LEFT_MARGIN + Inches(0.2), current_top + Inches(0.1), COL_WIDTH - Inches(0.4), box_h - Inches(0.2))
+        tx = slide.shapes.add_textbox(
+            LEFT_MARGIN + TAKEAWAY_PAD_X, current_top + TAKEAWAY_PAD_Y,
+            COL_WIDTH - 2 * TAKEAWAY_PAD_X, TAKEAWAY_H - 2 * TAKEAWAY_PAD_Y
+        )
         tf = tx.text_frame
         tf.word_wrap = True
         p = tf.paragraphs[0]
         p.text = takeaway
-        p.font.size = Pt(20)
+        p.font.size = PT_20
         p.font.bold = True
         p.font.name = font_name
-        p.font.color.rgb = RGBColor(0, 50, 100)
+        p.font.color.rgb = TAKEAWAY_FG
         p.alignment = PP_ALIGN.LEFT
         
-        current_top += box_h + Inches(0.3)
+        current_top += TAKEAWAY_H + TAKEAWAY_GAP
 
     # 3. Bullets
     if bullets:
-        # Estimated height for 3 bullets
-        bullets_h = Inches(2.0)
-        tx = slide.shapes.add_textbox(LEFT_MARGIN, current_top, COL_WIDTH, bullets_h)
+        tx = slide.shapes.add_textbox(LEFT_MARGIN, current_top, COL_WIDTH, BULLETS_H)
         tf = tx.text_frame
         tf.word_wrap = True
         for b in bullets:
             p = tf.add_paragraph()
             p.text = f"\u2022 {b}"
-            p.font.size = Pt(24)
+            p.font.size = PT_24
             p.font.name = font_name
-            p.font.color.rgb = RGBColor(30, 30, 30)
-            p.space_after = Pt(12)
+            p.font.color.rgb = BULLET_FG
+            p.space_after = PT_12
         
-        current_top += bullets_h + Inches(0.2)
+        current_top += BULLETS_H + BULLETS_GAP
 
     # 4. Body (Smaller font, explanatory text)
     if body:
-        body_h = Inches(2.5)  # Remaining space roughly
-        tx = slide.shapes.add_textbox(LEFT_MARGIN, current_top, COL_WIDTH, body_h)
+        tx = slide.shapes.add_textbox(LEFT_MARGIN, current_top, COL_WIDTH, BODY_H)
         tf = tx.text_frame
         tf.word_wrap = True
         p = tf.paragraphs[0]
         p.text = body
-        p.font.size = Pt(20)
+        p.font.size = PT_20
         p.font.name = font_name
-        p.font.color.rgb = RGBColor(50, 50, 50)
+        p.font.color.rgb = BODY_FG
         p.line_spacing = 1.3
 
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# JPEG start-of-frame markers (baseline, progressive, lossless, ...); DHT/JPG/DAC excluded
+_JPEG_SOF = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _read_image_size(image_path):
+    """
+    Return (width, height) in pixels from the PNG/JPEG header without
+    handing the file to an image library, or None for other formats.
+    """
+    with open(image_path, "rb") as f:
+        head = f.read(24)
+        if head[:8] == _PNG_SIGNATURE and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        if head[:2] != b"\xff\xd8":
+            return None
+        f.seek(2)
+        while True:
+            b = f.read(1)
+            while b and b != b"\xff":
+                b = f.read(1)
+            while b == b"\xff":  # fill bytes
+                b = f.read(1)
+            if not b:
+                return None
+            marker = b[0]
+            if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+                continue  # standalone markers carry no length
+            seg = f.read(2)
+            if len(seg) < 2:
+                return None
+            if marker in _JPEG_SOF:
+                data = f.read(5)  # precision, height, width
+                if len(data) < 5:
+                    return None
+                height, width = struct.unpack(">HH", data[1:5])
+                return width, height
+            f.seek(struct.unpack(">H", seg)[0] - 2, os.SEEK_CUR)
+
+
 def _add_image_contain(slide, image_path, left, top, max_width, max_height):
     """
     Add image fitting effectively within the box (Contain) maintaining aspect ratio.
     scale = min(box_w/img_w, box_h/img_h)
     """
-    if not image_path or not os.path.exists(image_path):
+    if not image_path:
         return
 
-    # Get image dimensions
+    # Get image dimensions (header only; PIL for anything else). Opening the
+    # file doubles as the existence check, so there is no separate stat.
     img_w, img_h = 100, 100 # defaults
-    if Image:
-        try:
+    try:
+        size = _read_image_size(image_path)
+    except OSError:
+        return  # missing or unreadable
+    try:
+        if size is None and Image:
             with Image.open(image_path) as img:
-                img_w, img_h = img.size
-        except Exception:
-            pass
+                size = img.size
+        if size and size[0] and size[1]:
+            img_w, img_h = size
+    except Exception:
+        pass
     
     # Calculate scale
     scale_w = max_width / img_w
@@ -158,41 +268,88 @@ def _add_image_contain(slide, image_path, left, top, max_width, max_height):
         image_path, final_left, final_top, width=final_w, height=final_h
     )
 
+def _use_sequential_image_partnames(prs):
+    """
+    python-pptx picks each new image partname by walking every part in the
+    package, which makes adding N distinct images O(N^2). A freshly built deck
+    never deletes images, so a running counter yields the same names. The
+    override is set on this package instance only, not on the class.
+    """
+    package = prs.part.package
+    existing = sum(1 for part in package.iter_parts() if part.partname.startswith("/ppt/media/image"))
+    counter = itertools.count(existing + 1)
+    package.next_image_partname = lambda ext: PackURI("/ppt/media/image%d.%s" % (next(counter), ext))
+
+
+def _use_image_part_index(prs):
+    """
+    python-pptx deduplicates pictures by scanning every image part in the
+    package for a matching SHA-1 on each add_picture, which is O(N^2) over a
+    deck. Keep an index on this package instead: by path (the same file is
+    neither re-read nor re-hashed) and by SHA-1 (identical bytes under a
+    different name still share one part).
+    """
+    package = prs.part.package
+    by_sha1 = {part.sha1: part for part in package.iter_parts() if isinstance(part, ImagePart)}
+    by_path = {}
+
+    def get_or_add_image_part(image_file):
+        key = image_file if isinstance(image_file, str) else None
+        part = by_path.get(key) if key else None
+        if part is None:
+            image = PptxImage.from_file(image_file)
+            part = by_sha1.get(image.sha1)
+            if part is None:
+                part = by_sha1[image.sha1] = ImagePart.new(package, image)
+            if key:
+                by_path[key] = part
+        return part
+
+    package.get_or_add_image_part = get_or_add_image_part
+
+
 def generate_pptx(plan, image_paths, output_path="presentation.pptx", title="Presentation"):
     """
     Generates PPTX for Video Presentation (2-column layout).
+
+    output_path may be a filesystem path or a writable binary file-like
+    object (e.g. io.BytesIO); it is returned unchanged.
     """
     prs = Presentation()
     # Widescreen 16:9 (13.33 x 7.5 inches)
-    prs.slide_width = Inches(13.333)
-    prs.slide_height = Inches(7.5)
+    prs.slide_width = SLIDE_W
+    prs.slide_height = SLIDE_H
+    _use_sequential_image_partnames(prs)
+    _use_image_part_index(prs)
 
     # Extract theme
     theme = plan.get('theme', {})
     font_name = theme.get('font', 'Meiryo')
     primary = _hex_to_rgb(theme.get('primary_color', '#2B579A'))
 
+    blank_layout = prs.slide_layouts[6]
+    slides = prs.slides
+
     # ── Cover Slide ──
-    cover = prs.slides.add_slide(prs.slide_layouts[6])
+    cover = slides.add_slide(blank_layout)
     _set_slide_bg(cover, primary)
     
     # Cover title
-    tx = cover.shapes.add_textbox(Inches(1), Inches(2.5), Inches(11), Inches(2.5))
+    tx = cover.shapes.add_textbox(*COVER_BOX)
     tf = tx.text_frame
     tf.word_wrap = True
     p = tf.paragraphs[0]
     p.text = title
-    p.font.size = Pt(54)
-    p.font.color.rgb = RGBColor(255, 255, 255)
+    p.font.size = PT_54
+    p.font.color.rgb = WHITE
     p.font.bold = True
     p.font.name = font_name
     p.alignment = PP_ALIGN.CENTER
 
-    # ── Content Slides ──
     # ── Content Slides ──
     for i, sd in enumerate(plan['slides']):
-        slide = prs.slides.add_slide(prs.slide_layouts[6])
-        _set_slide_bg(slide, RGBColor(255, 255, 255)) # White bg for content slides
+        slide = slides.add_slide(blank_layout)
+        _set_slide_bg(slide, WHITE) # White bg for content slides
         
         # 1. Left Content (Title -> Takeaway -> Bullets -> Body)
         _create_left_column(
@@ -205,17 +362,9 @@ def generate_pptx(plan, image_paths, output_path="presentation.pptx", title="Pre
         )
         
         # 2. Right Content (Image) - 40% area
-        # Slide Width 13.33. 
-        # Left 60% is roughly 8.0.
-        # Right area: Left=8.2, Top=0.5, Width=4.6, Height=6.5
-        img_left = Inches(8.2)
-        img_top = Inches(0.5)
-        img_w = Inches(4.6)
-        img_h = Inches(6.5)
-        
         # Visual Frame for Image Area (Optional, but good for layout debugging/structure)
         # bg_box = slide.shapes.add_shape(
-        #     MSO_SHAPE.RECTANGLE, img_left, img_top, img_w, img_h
+        #     MSO_SHAPE.RECTANGLE, IMG_LEFT, IMG_TOP, IMG_W, IMG_H
         # )
         # bg_box.fill.solid()
         # bg_box.fill.fore_color.rgb = RGBColor(245, 245, 245)
@@ -223,7 +372,12 @@ def generate_pptx(plan, image_paths, output_path="presentation.pptx", title="Pre
         
         img_path = image_paths.get(i)
         if img_path:
-            _add_image_contain(slide, img_path, img_left, img_top, img_w, img_h)
+            _add_image_contain(slide, img_path, IMG_LEFT, IMG_TOP, IMG_W, IMG_H)
 
-    prs.save(output_path)
+    if isinstance(output_path, (str, os.PathLike)):
+        # zipfile issues many small writes; buffer them into ~1 MiB syscalls
+        with open(output_path, "wb", buffering=1024 * 1024) as fh:
+            prs.save(fh)
+    else:
+        prs.save(output_path)
     return output_path
@@ -3,32 +3,98 @@ Phase A: Extract raw text from various input formats.
 
 Supports:
   - Plain text / Markdown
-  - PDF files (via PyPDF2)
+  - PDF files (via pdfminer.six when installed, else pypdf / PyPDF2)
 """
 
-import io
+import os
+import shutil
+import tempfile
 
+# Resolved on first PDF extraction so importing this module (text-only
+# inputs) does not pay for loading a PDF library.
+_PDF_BACKEND = None
+
+
+def _get_pdf_backend():
+    """
+    Return a function path -> list of raw page texts, importing the library once.
+
+    pdfminer.six parses shared fonts/CMaps once per document; PyPDF2 redoes
+    that work for every page, so pdfminer is preferred when it is available.
+    pypdf (the maintained successor of PyPDF2) is the per-page fallback.
+    Raises ImportError when none of them is installed.
+    """
+    global _PDF_BACKEND
+    if _PDF_BACKEND is not None:
+        return _PDF_BACKEND
 
-def extract_text_from_pdf(uploaded_file) -> str:
-    """Extract text from an uploaded PDF file (Streamlit UploadedFile)."""
     try:
-        from PyPDF2 import PdfReader
-
-        reader = PdfReader(io.BytesIO(uploaded_file.read()))
-        pages = []
-        for page in reader.pages:
-            text = page.extract_text()
-            if text:
-                pages.append(text.strip())
+        from pdfminer.high_level import extract_text as pdfminer_extract_text
+    except ImportError:
+        pdfminer_extract_text = None
+
+    if pdfminer_extract_text is not None:
+        def backend(path):
+            # One pass over the document; pages are separated by form feeds
+            text = pdfminer_extract_text(path)
+            raw_pages = text.split("\f")
+            if text.endswith("\f"):
+                raw_pages.pop()
+            return raw_pages
+    else:
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            from PyPDF2 import PdfReader
+
+        def backend(path):
+            return [page.extract_text() for page in PdfReader(path).pages]
+
+    _PDF_BACKEND = backend
+    return backend
+
+
+def _spool_to_disk(uploaded_file) -> str:
+    """Copy a non-seekable upload to a temp file in 1 MiB chunks; return its path."""
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        shutil.copyfileobj(uploaded_file, tmp, length=1 << 20)
+        return tmp.name
+
+
+def extract_text_from_pdf(source) -> str:
+    """
+    Extract text from a PDF.
+
+    Args:
+        source: A filesystem path, or a file-like upload (Streamlit UploadedFile).
+            Seekable uploads are handed to the parser as-is (no copy of the
+            PDF bytes); only non-seekable streams are spooled to a temp file.
+    """
+    spooled = None
+    try:
+        if isinstance(source, (str, os.PathLike)):
+            path = source
+        else:
+            try:
+                source.seek(0)
+                path = source
+            except (AttributeError, OSError):
+                path = spooled = _spool_to_disk(source)
+
+        raw_pages = _get_pdf_backend()(path)
+        pages = [text.strip() for text in raw_pages if text and text.strip()]
         result = "\n\n".join(pages)
-        print(f"[EXTRACT] PDF pages={len(reader.pages)}, chars={len(result)}")
+        print(f"[EXTRACT] PDF pages={len(raw_pages)}, chars={len(result)}")
         return result
     except ImportError:
-        print("[EXTRACT][WARN] PyPDF2 not installed, trying pdfminer")
+        print("[EXTRACT][WARN] none of pdfminer.six, pypdf or PyPDF2 is installed")
         raise
     except Exception as e:
         print(f"[EXTRACT][ERROR] PDF extraction failed: {e}")
         raise
+    finally:
+        if spooled:
+            os.unlink(spooled)
 
 
 def extract_text(source, source_type="text") -> str:
@@ -36,7 +102,8 @@ def extract_text(source, source_type="text") -> str:
     Unified text extraction.
 
     Args:
-        source: Either a string (text/markdown) or a Streamlit UploadedFile (PDF).
+        source: Either a string (text/markdown), or a path / Streamlit
+            UploadedFile (PDF).
         source_type: "text" or "pdf"
 
     Returns: